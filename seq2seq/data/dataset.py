@@ -49,63 +49,80 @@ class Seq2SeqDataset(Dataset):
         src_tokens = merge([s['source'] for s in samples])
         tgt_tokens = merge([s['target'] for s in samples])
         tgt_inputs = merge([s['target'] for s in samples], move_eos_to_beginning=True)
+        src_inputs = merge([s['source'] for s in samples], move_eos_to_beginning=True)
 
         # Sort by descending source length
         src_lengths = torch.LongTensor([s['source'].numel() for s in samples])
         src_lengths, sort_order = src_lengths.sort(descending=True)
+        tgt_lengths = torch.LongTensor([s['target'].numel() for s in samples]).index_select(0, sort_order)
         id = id.index_select(0, sort_order)
         src_tokens = src_tokens.index_select(0, sort_order)
         tgt_tokens = tgt_tokens.index_select(0, sort_order)
         tgt_inputs = tgt_inputs.index_select(0, sort_order)
+        src_inputs = src_inputs.index_select(0, sort_order)
 
         return {
             'id': id,
             'src_tokens': src_tokens,
             'src_lengths': src_lengths,
             'tgt_tokens': tgt_tokens,
+            'tgt_lengths': tgt_lengths,
             'tgt_inputs': tgt_inputs,
+            'src_inputs': src_inputs,
             'num_tokens': sum(len(s['target']) for s in samples),
         }
 
 
 class BatchSampler(Sampler):
-    def __init__(self, dataset, max_tokens=None, batch_size=None, num_shards=1, shard_id=0, shuffle=True, seed=42):
+    def __init__(self, dataset, max_tokens=None, batch_size=None, num_shards=1, shard_id=0, shuffle=True, seed=42,
+                 pool_size=None):
         self.dataset, self.shuffle, self.seed = dataset, shuffle, seed
+        self.pool_size = max(pool_size if pool_size is not None else len(dataset), 1)
         self.batch_size = batch_size if batch_size is not None else float('Inf')
         self.max_tokens = max_tokens if max_tokens is not None else float('Inf')
+        self.num_shards, self.shard_id, self.epoch = num_shards, shard_id, 0
         self.batches = self._batch_generator()
-
         self.shard_len = int(math.ceil(len(self.batches) / num_shards))
-        self.itr = itertools.zip_longest(
-            range(self.shard_len),
-            itertools.islice(self.batches, shard_id, len(self.batches), num_shards),
-            fillvalue=[])
 
     def __len__(self):
         return self.shard_len
 
-    def __iter__(self):
-        return self
+    def set_epoch(self, epoch):
+        """Sets the epoch used to seed the batch order, so that one sampler can serve all (including resumed) epochs."""
+        self.epoch = epoch
 
-    def __next__(self):
-        return next(self.itr)[1]
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle and self.epoch > 0:
+            batches = [batches[i] for i in np.random.RandomState(self.seed + self.epoch).permutation(len(batches))]
+        itr = itertools.zip_longest(
+            range(self.shard_len),
+            itertools.islice(batches, self.shard_id, len(batches), self.num_shards),
+            fillvalue=[])
+        return (batch for _, batch in itr)
 
     def _batch_generator(self):
         np.random.seed(self.seed)
         indices = np.random.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
-        indices = indices[np.argsort(self.dataset.tgt_sizes[indices], kind='mergesort')]
-        indices = indices[np.argsort(self.dataset.src_sizes[indices], kind='mergesort')]
-
-        batches, batch, sample_len = [], [], 0
-        for idx in indices:
-            batch.append(idx)
-            sample_len = max(sample_len, self.dataset.tgt_sizes[idx])
-            num_tokens = len(batch) * sample_len
-            if len(batch) == self.batch_size or num_tokens > self.max_tokens:
+
+        # Bucket by length: sort sentences within each pool so that batches hold sentences of similar length
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start: start + self.pool_size]
+            pool = pool[np.argsort(self.dataset.tgt_sizes[pool], kind='mergesort')]
+            pool = pool[np.argsort(self.dataset.src_sizes[pool], kind='mergesort')]
+
+            batch, sample_len = [], 0
+            for idx in pool:
+                batch.append(idx)
+                # Count padded tokens on the longer side of the batch
+                sample_len = max(sample_len, self.dataset.src_sizes[idx], self.dataset.tgt_sizes[idx])
+                num_tokens = len(batch) * sample_len
+                if len(batch) == self.batch_size or num_tokens > self.max_tokens:
+                    batches.append(batch)
+                    batch, sample_len = [], 0
+            if len(batch) > 0:
                 batches.append(batch)
-                batch, sample_len = [], 0
-        if len(batch) > 0:
-            batches.append(batch)
 
         if self.shuffle:
             np.random.shuffle(batches)
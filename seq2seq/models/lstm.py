@@ -115,8 +115,10 @@ class LSTMEncoder(Seq2SeqEncoder):
         # Transpose batch: [batch_size, src_time_steps, num_features] -> [src_time_steps, batch_size, num_features]
         src_embeddings = _src_embeddings.transpose(0, 1)
 
-        # Pack embedded tokens into a PackedSequence
-        packed_source_embeddings = nn.utils.rnn.pack_padded_sequence(src_embeddings, src_lengths)
+        # Pack embedded tokens into a PackedSequence, so that the LSTM skips padded time steps
+        # Lengths need not be sorted, as the reverse model encodes target sentences in source-length order
+        packed_source_embeddings = nn.utils.rnn.pack_padded_sequence(src_embeddings, src_lengths.cpu(),
+                                                                     enforce_sorted=False)
 
         # Pass source input through the recurrent layer(s)
         packed_outputs, (final_hidden_states, final_cell_states) = self.lstm(packed_source_embeddings)
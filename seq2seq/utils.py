@@ -30,7 +30,7 @@ def load_embedding(embed_path, dictionary):
 
 def move_to_cuda(sample):
     if torch.is_tensor(sample):
-        return sample.cuda()
+        return sample.cuda(non_blocking=True)
     elif isinstance(sample, list):
         return [move_to_cuda(x) for x in sample]
     elif isinstance(sample, dict):
@@ -39,7 +39,39 @@ def move_to_cuda(sample):
         return sample
 
 
-def save_checkpoint(args, model, model_rev, optimizer, epoch, valid_loss):
+def prefetch_to_cuda(iterable):
+    """Iterate over samples moved to the GPU, copying the next sample on a side stream while the current one is used.
+    Samples should come from pinned memory, so that the copies run asynchronously."""
+    copy_stream = torch.cuda.Stream()
+
+    def record_stream(sample, stream):
+        # Tell the allocator that the copied tensors are now used by the compute stream
+        if torch.is_tensor(sample):
+            sample.record_stream(stream)
+        elif isinstance(sample, list):
+            for x in sample:
+                record_stream(x, stream)
+        elif isinstance(sample, dict):
+            for value in sample.values():
+                record_stream(value, stream)
+
+    def next_sample(itr):
+        sample = next(itr, None)
+        if sample is not None:
+            with torch.cuda.stream(copy_stream):
+                sample = move_to_cuda(sample)
+        return sample
+
+    itr = iter(iterable)
+    sample = next_sample(itr)
+    while sample is not None:
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        record_stream(sample, torch.cuda.current_stream())
+        current, sample = sample, next_sample(itr)
+        yield current
+
+
+def save_checkpoint(args, model, model_rev, optimizer, scaler, epoch, valid_loss):
     os.makedirs(args.save_dir, exist_ok=True)
     last_epoch = getattr(save_checkpoint, 'last_epoch', -1)
     save_checkpoint.last_epoch = max(last_epoch, epoch)
@@ -53,6 +85,7 @@ def save_checkpoint(args, model, model_rev, optimizer, epoch, valid_loss):
         'last_epoch': save_checkpoint.last_epoch,
         'model': model.state_dict(),
         'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
         'args': args,
     }
 
@@ -60,7 +93,6 @@ def save_checkpoint(args, model, model_rev, optimizer, epoch, valid_loss):
         'epoch': epoch,
         'last_epoch': save_checkpoint.last_epoch,
         'model': model_rev.state_dict(),
-        'optimizer': optimizer.state_dict(),
         'args': args,
     }
 
@@ -75,23 +107,31 @@ def save_checkpoint(args, model, model_rev, optimizer, epoch, valid_loss):
         torch.save(state_dict_rev, os.path.join(args.save_dir, 'checkpoint_last_rev.pt'))
 
 
-def load_checkpoint(args, model, optimizer):
+def load_checkpoint(args, model, optimizer, scaler):
     checkpoint_path = os.path.join(args.save_dir, args.restore_file)
     if os.path.isfile(checkpoint_path):
         state_dict = torch.load(checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
         model.load_state_dict(state_dict['model'])
-        optimizer.load_state_dict(state_dict['optimizer'])
+        try:
+            optimizer.load_state_dict(state_dict['optimizer'])
+        except ValueError:
+            # Older checkpoints hold optimizer state for the forward model only, which the joint optimizer cannot use
+            logging.info('Optimizer state in {} does not match the joint optimizer; starting a fresh optimizer'.format(
+                checkpoint_path))
+        # A scaler saved while mixed precision was disabled has an empty state, which cannot be loaded
+        if state_dict.get('scaler'):
+            scaler.load_state_dict(state_dict['scaler'])
         save_checkpoint.best_loss = state_dict['best_loss']
         save_checkpoint.last_epoch = state_dict['last_epoch']
         logging.info('Loaded checkpoint {}'.format(checkpoint_path))
         return state_dict
         
-def load_checkpoint_rev(args, model, optimizer):
+def load_checkpoint_rev(args, model):
+    # The joint optimizer state is restored from the forward checkpoint only
     checkpoint_path = os.path.join(args.save_dir, args.restore_file_rev)
     if os.path.isfile(checkpoint_path):
         state_dict = torch.load(checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
         model.load_state_dict(state_dict['model'])
-        optimizer.load_state_dict(state_dict['optimizer'])
         save_checkpoint.last_epoch = state_dict['last_epoch']
         logging.info('Loaded checkpoint {}'.format(checkpoint_path))
         return state_dict
@@ -25,6 +25,8 @@ def get_args():
     parser.add_argument('--target-lang', default='en', help='target language')
     parser.add_argument('--max-tokens', default=None, type=int, help='maximum number of tokens in a batch')
     parser.add_argument('--batch-size', default=100, type=int, help='maximum number of sentences in a batch')
+    parser.add_argument('--bucket-pool-size', default=None, type=int,
+                        help='sort sentences by length within pools of this size (default: the whole dataset)')
     parser.add_argument('--train-on-tiny', action='store_true', help='train model on a tiny dataset')
 
     # Add model arguments
@@ -32,13 +34,22 @@ def get_args():
 
     # Add optimization arguments
     parser.add_argument('--max-epoch', default=10000, type=int, help='force stop training at specified epoch')
+    parser.add_argument('--rev-interval', default=1, type=int,
+                        help='train the reverse model and attention agreement only every N steps')
     parser.add_argument('--clip-norm', default=4.0, type=float, help='clip threshold of gradients')
     parser.add_argument('--lr', default=0.0003, type=float, help='learning rate')
+    parser.add_argument('--weight-decay', default=0.0, type=float, help='decoupled weight decay (0 matches Adam)')
+    parser.add_argument('--no-amp', action='store_true', help='disable mixed precision training on the GPU')
+    parser.add_argument('--compile', action='store_true', help='compile get_diff with torch.compile')
+    parser.add_argument('--compile-mode', default='default', choices=['default', 'reduce-overhead', 'max-autotune'],
+                        help='torch.compile mode for get_diff; reduce-overhead records one CUDA graph per distinct '
+                             'batch shape and replays it when that shape repeats')
     parser.add_argument('--patience', default=5, type=int,
                         help='number of epochs without improvement on validation set before early stopping')
 
     # Add checkpoint arguments
     parser.add_argument('--log-file', default=None, help='path to save logs')
+    parser.add_argument('--log-interval', type=int, default=50, help='update the progress bar every N batches')
     parser.add_argument('--save-dir', default='checkpoints', help='path to save checkpoints')
     parser.add_argument('--restore-file', default='checkpoint_last.pt', help='filename to load checkpoint')
     parser.add_argument('--restore-file-rev', default='checkpoint_last_rev.pt', help='filename to load checkpoint')
@@ -51,17 +62,22 @@ def get_args():
     model_parser = parser.add_argument_group(argument_default=argparse.SUPPRESS)
     ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
     args = parser.parse_args()
+    if args.rev_interval < 1:
+        parser.error('--rev-interval must be at least 1')
+    if args.log_interval < 1:
+        parser.error('--log-interval must be at least 1')
+    args.use_amp = args.cuda and not args.no_amp
     ARCH_CONFIG_REGISTRY[args.arch](args)
     return args
 
 def get_diff(att, src_out, att_rev, src_out_rev):
     def calculate_diff(acontext, src_out_other):
-        src_out_other = src_out_other.transpose(1, 2)
-        diff = torch.bmm(acontext, src_out_other)
+        diff = torch.bmm(acontext, src_out_other.transpose(1, 2))
         diag = torch.diagonal(diff, dim1=1, dim2=2)
-        numerator = torch.norm(diag, p=1)/len(diag)
-        diff = diff.view(-1)
-        denominator = (torch.norm(diff, p=1) - torch.norm(diag, p=1))/(len(diff) - len(diag))
+        # Reuse the L1 mass of the diagonal for the off-diagonal term
+        diag_norm = diag.abs().sum()
+        numerator = diag_norm/diag.numel()
+        denominator = (diff.abs().sum() - diag_norm)/(diff.numel() - diag.numel())
         return numerator/denominator
     src_out = src_out.transpose(0, 1)
     src_out_rev = src_out_rev.transpose(0, 1)
@@ -71,14 +87,7 @@ def get_diff(att, src_out, att_rev, src_out_rev):
     d = calculate_diff(acontext, src_out_rev)
     d_rev = calculate_diff(acontext_rev, src_out)
 
-    # print(d.cpu().detach().numpy())
-    d=d.cpu().detach().numpy()
-    d=torch.from_numpy(d)
-
-    d_rev=d_rev.cpu().detach().numpy()
-    d_rev=torch.from_numpy(d_rev)
-    # print(src_out)
-    # print(att2)
+    # Keep d and d_rev on-device and attached to the graph, so that they contribute gradients to the loss
     return d, d_rev
 
 def main(args):
@@ -117,109 +126,107 @@ def main(args):
         model_rev = model_rev.cuda()
         criterion = criterion.cuda()
 
+    # Only get_diff is compiled: the decoder's per-time-step Python loop would be unrolled and recompiled for every
+    # target length, and the encoder breaks the graph on packing and on its padding check
+    diff_fn = torch.compile(get_diff, mode=args.compile_mode, dynamic=True) if args.compile else get_diff
+
     # Instantiate optimizer and learning rate scheduler
-    optimizer = torch.optim.Adam(model.parameters(), args.lr)
+    # Both translation directions are trained jointly, so a single optimizer updates the two models
+    params = list(model.parameters()) + list(model_rev.parameters())
+    optimizer = torch.optim.AdamW(params, args.lr, weight_decay=args.weight_decay, fused=args.cuda)
+    # Run forward passes in bfloat16 where safe; the scaler is a no-op unless mixed precision is enabled
+    scaler = torch.amp.GradScaler('cuda', enabled=args.use_amp)
 
     # Load last checkpoint if one exists
-    state_dict = utils.load_checkpoint(args, model, optimizer)  # lr_scheduler
-    utils.load_checkpoint_rev(args, model_rev, optimizer)  # lr_scheduler
+    state_dict = utils.load_checkpoint(args, model, optimizer, scaler)  # lr_scheduler
+    utils.load_checkpoint_rev(args, model_rev)
     last_epoch = state_dict['last_epoch'] if state_dict is not None else -1
 
     # Track validation performance for early stopping
     bad_epochs = 0
     best_validate = float('inf')
 
+    # Build the training loader once; its workers persist across epochs and the sampler is re-seeded per epoch
+    train_loader = \
+        torch.utils.data.DataLoader(train_dataset, num_workers=4, collate_fn=train_dataset.collater,
+                                    pin_memory=args.cuda, persistent_workers=True, prefetch_factor=4,
+                                    batch_sampler=BatchSampler(train_dataset, args.max_tokens, args.batch_size, 1,
+                                                               0, shuffle=True, seed=42,
+                                                               pool_size=args.bucket_pool_size))
+
     for epoch in range(last_epoch + 1, args.max_epoch):
-        train_loader = \
-            torch.utils.data.DataLoader(train_dataset, num_workers=1, collate_fn=train_dataset.collater,
-                                        batch_sampler=BatchSampler(train_dataset, args.max_tokens, args.batch_size, 1,
-                                                                   0, shuffle=True, seed=42))
+        train_loader.batch_sampler.set_epoch(epoch)
         model.train()
         model_rev.train()
         stats = OrderedDict()
         stats['loss'] = 0
+        stats['loss_rev'] = 0
         stats['lr'] = 0
         stats['num_tokens'] = 0
         stats['batch_size'] = 0
         stats['grad_norm'] = 0
         stats['clip'] = 0
+        # The reverse loss is only computed every --rev-interval steps, so it is averaged over those steps only
+        rev_steps = 0
+
+        def averages(num_steps):
+            return {key: value / (max(rev_steps, 1) if key == 'loss_rev' else num_steps)
+                    for key, value in stats.items()}
+
         # Display progress
-        progress_bar = tqdm(train_loader, desc='| Epoch {:03d}'.format(epoch), leave=False, disable=False)
+        # On the GPU, the next batch is copied on a side stream while the current one is processed
+        batches = utils.prefetch_to_cuda(train_loader) if args.cuda else train_loader
+        progress_bar = tqdm(batches, total=len(train_loader), desc='| Epoch {:03d}'.format(epoch), leave=False,
+                            disable=False)
 
         # Iterate over the training set
+        # Avoid reading tensors back to the host (.item(), .cpu(), .numpy(), print) in this loop: each read stalls
+        # the GPU until all queued work has finished
         for i, sample in enumerate(progress_bar):
-            if args.cuda:
-                sample = utils.move_to_cuda(sample)
             if len(sample) == 0:
                 continue
             model.train()
-
-            (output, att), src_out = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
-            # print(sample['src_lengths'])
-            # print(sample['tgt_inputs'].size())
-            # print(sample['src_tokens'].size())
-            src_inputs = sample['src_tokens'].clone()
-            src_inputs[0,1:src_inputs.size(1)] = sample['src_tokens'][0,0:(src_inputs.size(1)-1)]
-            src_inputs[0,0] = sample['src_tokens'][0,src_inputs.size(1)-1]
-            tgt_lengths = sample['src_lengths'].clone()#torch.tensor([sample['tgt_tokens'].size(1)])
-            tgt_lengths += sample['tgt_inputs'].size(1) - sample['src_tokens'].size(1)
-            # print(tgt_lengths)
-            # print(sample['num_tokens'])
-            
-            # if args.cuda:
-            #     tgt_lengths = tgt_lengths.cuda()
-            (output_rev, att_rev), src_out_rev = model_rev(sample['tgt_tokens'], tgt_lengths, src_inputs)
-
-            # notice that those are without masks already
-            # print(sample['tgt_tokens'].view(-1))
-            d, d_rev = get_diff(att, src_out, att_rev, src_out_rev)
-            
-            # print(sample['src_tokens'].size())
-            # print(sample['tgt_inputs'].size())
-            # print(att.size())
-            # print(src_out.size())
-            # print(acontext.size())
-            # print(src_out_rev.size())
-            # # print(sample['tgt_inputs'].dtype)
-            # # print(sample['src_lengths'])
-            # # print(sample['src_tokens'])
-            # # print('output %s' % str(output.size()))
-            # # print(att)
-            # # print(len(sample['src_lengths']))
-            # print(d)
-            # print(d_rev)
-            # print(criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1)) / len(sample['src_lengths']))
-            # print(att2)
-            # output=output.cpu().detach().numpy()
-            # output=torch.from_numpy(output).cuda()
-            # output_rev=output_rev.cpu().detach().numpy()
-            # output_rev=torch.from_numpy(output_rev).cuda()
-            loss = \
-                criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1)) / len(sample['src_lengths'])  + d +\
-                criterion(output_rev.view(-1, output_rev.size(-1)), sample['src_tokens'].view(-1)) / len(tgt_lengths) +d_rev
-            loss.backward()
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_norm)
-            # loss_rev = \
-            #     criterion(output_rev.view(-1, output_rev.size(-1)), sample['src_tokens'].view(-1)) / len(tgt_lengths) 
-            # loss_rev.backward()
-            # grad_norm_rev = torch.nn.utils.clip_grad_norm_(model_rev.parameters(), args.clip_norm)
-            optimizer.step()
-            optimizer.zero_grad()
-
-            # Update statistics for progress bar
-            total_loss, num_tokens, batch_size = (loss-d-d_rev).item(), sample['num_tokens'], len(sample['src_tokens'])
-            stats['loss'] += total_loss * len(sample['src_lengths']) / sample['num_tokens']
-            # stats['loss_rev'] += loss_rev.item() * len(sample['src_lengths']) / sample['src_tokens'].size(0) / sample['src_tokens'].size(1)
+            optimizer.zero_grad(set_to_none=True)
+            # Batch size and token count are fixed for the batch, so look them up once
+            bsz, ntok = sample['src_tokens'].size(0), sample['num_tokens']
+
+            with torch.amp.autocast('cuda', enabled=args.use_amp, dtype=torch.bfloat16):
+                (output, att), src_out = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
+                nll_loss = criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1))
+                loss = nll_loss / bsz
+
+                # The reverse model and the attention-diff terms are only computed every --rev-interval steps
+                train_rev = i % args.rev_interval == 0
+                if train_rev:
+                    (output_rev, att_rev), src_out_rev = \
+                        model_rev(sample['tgt_tokens'], sample['tgt_lengths'], sample['src_inputs'])
+
+                    # notice that those are without masks already
+                    d, d_rev = diff_fn(att, src_out, att_rev, src_out_rev)
+                    nll_loss_rev = criterion(output_rev.view(-1, output_rev.size(-1)), sample['src_tokens'].view(-1))
+                    loss = loss + nll_loss_rev / bsz + d + d_rev
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(params, args.clip_norm, foreach=True)
+            scaler.step(optimizer)
+            scaler.update()
+
+            # Update statistics for progress bar; tensor statistics stay on the device until they are displayed
+            stats['loss'] += nll_loss.detach() / ntok
+            if train_rev:
+                stats['loss_rev'] += nll_loss_rev.detach() / sample['src_lengths'].sum()
+                rev_steps += 1
             stats['lr'] += optimizer.param_groups[0]['lr']
-            stats['num_tokens'] += num_tokens / len(sample['src_tokens'])
-            stats['batch_size'] += batch_size
-            stats['grad_norm'] += grad_norm
-            stats['clip'] += 1 if grad_norm > args.clip_norm else 0
-            progress_bar.set_postfix({key: '{:.4g}'.format(value / (i + 1)) for key, value in stats.items()},
-                                     refresh=True)
+            stats['num_tokens'] += ntok / bsz
+            stats['batch_size'] += bsz
+            stats['grad_norm'] += grad_norm.detach()
+            stats['clip'] += (grad_norm > args.clip_norm).long()
+            if i % args.log_interval == 0:
+                progress_bar.set_postfix({key: '{:.4g}'.format(value) for key, value in averages(i + 1).items()},
+                                         refresh=True)
 
         logging.info('Epoch {:03d}: {}'.format(epoch, ' | '.join(key + ' {:.4g}'.format(
-            value / len(progress_bar)) for key, value in stats.items())))
+            value) for key, value in averages(len(progress_bar)).items())))
 
         # Calculate validation loss
         valid_perplexity = validate(args, model, model_rev, criterion, valid_dataset, epoch)
@@ -228,7 +235,7 @@ def main(args):
 
         # Save checkpoints
         if epoch % args.save_interval == 0:
-            utils.save_checkpoint(args, model, model_rev, optimizer, epoch, valid_perplexity)  # lr_scheduler
+            utils.save_checkpoint(args, model, model_rev, optimizer, scaler, epoch, valid_perplexity)  # lr_scheduler
 
         # Check whether to terminate training
         if valid_perplexity < best_validate:
@@ -260,20 +267,16 @@ def validate(args, model, model_rev, criterion, valid_dataset, epoch):
             sample = utils.move_to_cuda(sample)
         if len(sample) == 0:
             continue
-        with torch.no_grad():
+        with torch.inference_mode(), torch.amp.autocast('cuda', enabled=args.use_amp, dtype=torch.bfloat16):
             # Compute loss
             (output, attn_scores), src_out = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
             
-            src_inputs = sample['src_tokens'].clone()
-            src_inputs[0,1:src_inputs.size(1)] = sample['src_tokens'][0,0:(src_inputs.size(1)-1)]
-            src_inputs[0,0] = sample['src_tokens'][0,src_inputs.size(1)-1]
-            tgt_lengths = sample['src_lengths'].clone()#torch.tensor([sample['tgt_tokens'].size(1)])
-            tgt_lengths += sample['tgt_inputs'].size(1) - sample['src_tokens'].size(1)
-            (output_rev, attn_scores_rev), src_out_rev = model_rev(sample['tgt_tokens'], tgt_lengths, src_inputs)
+            (output_rev, attn_scores_rev), src_out_rev = \
+                model_rev(sample['tgt_tokens'], sample['tgt_lengths'], sample['src_inputs'])
 
             d, d_rev = get_diff(attn_scores, src_out, attn_scores_rev, src_out_rev)
             loss = criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1)) + d + \
-                criterion(output_rev.view(-1, output_rev.size(-1)), sample['src_tokens'].view(-1)) / len(tgt_lengths) + d_rev
+                criterion(output_rev.view(-1, output_rev.size(-1)), sample['src_tokens'].view(-1)) / sample['src_tokens'].size(0) + d_rev
         # Update tracked statistics
         stats['valid_loss'] += loss.item()
         stats['num_tokens'] += sample['num_tokens']